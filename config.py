@@ -5,56 +5,107 @@ VLM Dataset Creator - Configuration
 """
 
 import os
+import re
+import json
+import time
+import base64
+import functools
+import threading
+from collections import deque
 from pathlib import Path
 
+# 可选依赖: orjson（更快的 JSON 序列化，未安装时使用标准库 json）
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 # ==============================================================================
 # 环境变量加载
 # ==============================================================================
 
-def _load_env_value(key_name):
-    """从环境变量或 .env 文件加载配置值"""
-    value = os.getenv(key_name)
-    if value:
-        return value
+_ENV_FILE = Path(__file__).parent / '.env'
 
+# .env 行格式: KEY=value / KEY="value" / KEY='value'，支持行尾 # 注释
+# （与 python-dotenv 一致，# 前须有空白才视为注释，未加引号的值中可以包含 #）
+_ENV_LINE_RE = re.compile(
+    r'^[ \t]*([A-Za-z_]\w*)[ \t]*=[ \t]*'
+    r'(?:"([^"\n]*)"|\'([^\'\n]*)\'|([^\n]*?))'
+    r'(?:[ \t]+#.*)?[ \t]*$',
+    re.MULTILINE
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _parse_dotenv():
+    """解析 .env 文件为字典（仅解析一次，结果缓存）"""
+    values = {}
     try:
-        env_file = Path(__file__).parent / '.env'
-        if env_file.exists():
-            with open(env_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#') and '=' in line:
-                        key, val = line.split('=', 1)
-                        if key.strip() == key_name:
-                            val = val.strip()
-                            if (val.startswith('"') and val.endswith('"')) or \
-                               (val.startswith("'") and val.endswith("'")):
-                                val = val[1:-1]
-                            return val
+        if _ENV_FILE.exists():
+            text = _ENV_FILE.read_text(encoding='utf-8')
+            for m in _ENV_LINE_RE.finditer(text):
+                double_quoted, single_quoted, bare = m.group(2, 3, 4)
+                if double_quoted is not None:
+                    val = double_quoted
+                elif single_quoted is not None:
+                    val = single_quoted
+                else:
+                    val = bare
+                values.setdefault(m.group(1), val)
     except Exception as e:
         print(f"警告：读取 .env 文件时出错: {e}")
-    return None
+    return values
+
+
+@functools.lru_cache(maxsize=None)
+def _getenv_cached(key_name):
+    """读取环境变量（按键缓存）"""
+    return os.getenv(key_name)
+
+
+def invalidate_env_cache():
+    """清除环境变量和 .env 解析缓存（修改 os.environ / .env 后或测试中使用）"""
+    _getenv_cached.cache_clear()
+    _parse_dotenv.cache_clear()
+
+
+def _load_env_value(key_name):
+    """从环境变量或 .env 文件加载配置值"""
+    return _getenv_cached(key_name) or _parse_dotenv().get(key_name)
 
 
 # ==============================================================================
 # API 配置
 # ==============================================================================
 
+# 配置项 -> (环境变量名, 默认值)
+_ENV_SPEC = {
+    "api_key": ("OPENAI_API_KEY", None),
+    "base_url": ("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+    "model_name": ("MODEL_NAME", "gpt-4o"),
+}
+
+
+def load_env_config(name):
+    """按 _ENV_SPEC 加载单个配置项，未配置时返回默认值"""
+    env_key, default = _ENV_SPEC[name]
+    return _load_env_value(env_key) or default
+
+
 def load_api_key():
     """加载 API 密钥 (OPENAI_API_KEY)"""
-    return _load_env_value('OPENAI_API_KEY')
+    return load_env_config("api_key")
 
 
 def load_base_url():
     """加载 API Base URL (OPENAI_BASE_URL)"""
-    base_url = _load_env_value('OPENAI_BASE_URL')
-    return base_url if base_url else "https://api.openai.com/v1"
+    return load_env_config("base_url")
 
 
 def load_model_name():
     """加载模型名称 (MODEL_NAME)"""
-    model_name = _load_env_value('MODEL_NAME')
-    return model_name if model_name else "gpt-4o"
+    return load_env_config("model_name")
 
 
 # ==============================================================================
@@ -64,106 +115,108 @@ def load_model_name():
 # 项目根目录
 PROJECT_ROOT = Path(__file__).parent
 
+
 # 输入输出目录配置
-PATHS = {
-    # 原始文档目录
-    "input_documents": PROJECT_ROOT / "data" / "01_raw_documents",
-
-    # 流水线中间结果目录
-    "step1_images": PROJECT_ROOT / "data" / "02_images",           # 文档转换后的图片
-    "step2_ocr": PROJECT_ROOT / "data" / "03_ocr_results",         # OCR结果
-    "step3_grouping": PROJECT_ROOT / "data" / "04_vlm_grouping",   # VLM第一阶段-分组结果
-    "step4_classification": PROJECT_ROOT / "data" / "05_vlm_classification",  # VLM第二阶段-分类结果
-    "step5_funsd": PROJECT_ROOT / "data" / "06_funsd_output",      # 最终FUNSD格式
-
-    # 可视化目录
-    "visualizations": PROJECT_ROOT / "data" / "visualizations",    # 可视化结果
-
-    # 临时文件目录
-    "temp": PROJECT_ROOT / "temp",
-}
+@functools.lru_cache(maxsize=1)
+def _build_paths():
+    """构建输入输出目录配置（首次访问 PATHS 时执行）"""
+    return {
+        # 原始文档目录
+        "input_documents": PROJECT_ROOT / "data" / "01_raw_documents",
+
+        # 流水线中间结果目录
+        "step1_images": PROJECT_ROOT / "data" / "02_images",           # 文档转换后的图片
+        "step2_ocr": PROJECT_ROOT / "data" / "03_ocr_results",         # OCR结果
+        "step3_grouping": PROJECT_ROOT / "data" / "04_vlm_grouping",   # VLM第一阶段-分组结果
+        "step4_classification": PROJECT_ROOT / "data" / "05_vlm_classification",  # VLM第二阶段-分类结果
+        "step5_funsd": PROJECT_ROOT / "data" / "06_funsd_output",      # 最终FUNSD格式
+
+        # 可视化目录
+        "visualizations": PROJECT_ROOT / "data" / "visualizations",    # 可视化结果
+
+        # 临时文件目录
+        "temp": PROJECT_ROOT / "temp",
+        "ocr_cache": PROJECT_ROOT / "temp" / "ocr_cache",             # OCR结果缓存（按图片内容哈希）
+        "vlm_cache": PROJECT_ROOT / "temp" / "vlm_cache",             # VLM分类结果缓存（按图片和提示词哈希）
+    }
 
 
 # ==============================================================================
 # 默认配置
 # ==============================================================================
 
+def available_cpu_count() -> int:
+    """当前进程可用的 CPU 核数
+
+    优先使用 sched_getaffinity，在容器/taskset 限制核数时不会高估；不支持的平台回退到 os.cpu_count()。
+    """
+    try:
+        return len(os.sched_getaffinity(0)) or 1
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
 DEFAULT_CONFIG = {
     # API 配置
-    "api_key": load_api_key(),
-    "base_url": load_base_url(),
-    "model_name": load_model_name(),
+    **{name: load_env_config(name) for name in _ENV_SPEC},
 
     # 批处理配置
-    "batch_size": 5,
-    "interval": 15,  # 批次间隔（秒）
+    "batch_size": 5,  # 并发请求数（VLM 步骤）
+    "interval": 15,  # 限流窗口（秒）：任意 interval 秒内最多发出 batch_size 个请求
+    "vlm_json_mode": False,  # 分类步骤使用 JSON 模式 (response_format=json_object)，需 API 支持
+    "vlm_max_retries": 5,  # 请求失败重试次数（429/5xx/超时，指数退避 + 抖动）
+    "vlm_timeout": 120,  # 单次请求超时（秒）
+    # 按图片内容和提示词缓存分类结果 (temp/vlm_cache)，只在图片和提示词完全相同时命中，
+    # 主要用于重复页面；删除分类输出重新运行时会复用旧结果，需要新结果时应关闭或清空缓存
+    "vlm_cache": False,
 
     # 图像处理配置
     "image_dpi": 300,
     "only_first_page": True,
+    "vis_compress_level": 1,  # 可视化 PNG 压缩级别 (0-9)，越低编码越快、文件越大
 
     # OCR配置
     "ocr_lang": "ch",  # PaddleOCR语言: ch, en, japan, korean等
+    "ocr_workers": 1,  # OCR 并行进程数（每个进程加载一份模型）
+    "ocr_cache": True,  # 按图片内容缓存 OCR 结果，重复运行时跳过识别
+    "ocr_enable_mkldnn": False,  # CPU 推理启用 MKL-DNN (oneDNN) 加速，部分非 Intel CPU 上可能不稳定
+    "ocr_cpu_threads": 0,  # 每个进程的推理线程数，0 表示按 CPU 核数 / ocr_workers 自动分配
+    "ocr_precision": "fp32",  # 推理精度: fp32, fp16, int8（int8 需配合量化模型与 MKL-DNN）
+    "ocr_det_model_dir": None,  # 自定义检测模型目录，None 使用默认模型
+    "ocr_rec_model_dir": None,  # 自定义识别模型目录
+    "ocr_cls_model_dir": None,  # 自定义方向分类模型目录
 
     # 置信度配置
     "confidence_threshold": 0.5,
+
+    # 并行配置
+    "num_workers": available_cpu_count(),  # 本地处理步骤的并行进程数
 }
 
 
 # ==============================================================================
-# 海运单标签定义
+# 延迟属性 (PEP 562)
 # ==============================================================================
+#
+# PATHS 和标签表（定义见 labels.py）在首次访问时才构建，
+# 只需要 API 配置的脚本无需为它们付出导入开销。
+
+_LABEL_ATTRS = (
+    "BILL_OF_LADING_LABELS", "LABEL_ID_TO_NAME", "LABEL_ID_TO_NAME_CN",
+    "LABEL_ID_TO_CATEGORY", "LABEL_NAME_TO_ID",
+)
 
-BILL_OF_LADING_LABELS = {
-    # 核心角色类
-    0: {"name": "shipper", "name_cn": "托运人", "category": "role"},
-    1: {"name": "consignee", "name_cn": "收货人", "category": "role"},
-    2: {"name": "notify_party", "name_cn": "通知方", "category": "role"},
-
-    # 地理信息类
-    3: {"name": "port_of_loading", "name_cn": "装货港", "category": "geography"},
-    4: {"name": "port_of_discharge", "name_cn": "卸货港", "category": "geography"},
-    5: {"name": "port_of_delivery", "name_cn": "交货港", "category": "geography"},
-    6: {"name": "place_of_delivery", "name_cn": "交货地点", "category": "geography"},
-    7: {"name": "place_of_receipt", "name_cn": "收货地点", "category": "geography"},
-
-    # 运输信息类
-    8: {"name": "vessel", "name_cn": "船名", "category": "transport"},
-    9: {"name": "voyage", "name_cn": "航次", "category": "transport"},
-    10: {"name": "vessel_voyage", "name_cn": "船名航次", "category": "transport"},
-    11: {"name": "container_no", "name_cn": "集装箱号", "category": "transport"},
-    12: {"name": "seal_no", "name_cn": "封号", "category": "transport"},
-
-    # 货物信息类
-    13: {"name": "description_of_goods", "name_cn": "货物描述", "category": "cargo"},
-    14: {"name": "marks_numbers", "name_cn": "唛头和编号", "category": "cargo"},
-    15: {"name": "package", "name_cn": "包装件数", "category": "cargo"},
-    16: {"name": "weight", "name_cn": "重量", "category": "cargo"},
-    17: {"name": "volume", "name_cn": "体积", "category": "cargo"},
-
-    # 编号日期类
-    18: {"name": "bl_no", "name_cn": "提单号", "category": "number"},
-    19: {"name": "freight", "name_cn": "运费", "category": "number"},
-    20: {"name": "date", "name_cn": "日期", "category": "number"},
-    21: {"name": "time", "name_cn": "时间", "category": "number"},
-
-    # 特殊标识类
-    22: {"name": "header", "name_cn": "头部信息", "category": "layout"},
-    23: {"name": "footer", "name_cn": "底部信息", "category": "layout"},
-    24: {"name": "company_logo", "name_cn": "公司标志", "category": "layout"},
-
-    # 费率类
-    25: {"name": "rate", "name_cn": "费率", "category": "rate"},
-    26: {"name": "total", "name_cn": "总计", "category": "rate"},
-
-    # 其他
-    27: {"name": "other", "name_cn": "其他信息", "category": "other"},
-    28: {"name": "abandon", "name_cn": "废弃内容", "category": "other"},
-}
 
-# 标签ID到名称的快速映射
-LABEL_ID_TO_NAME = {k: v["name"] for k, v in BILL_OF_LADING_LABELS.items()}
-LABEL_NAME_TO_ID = {v["name"]: k for k, v in BILL_OF_LADING_LABELS.items()}
+def __getattr__(name):
+    if name == "PATHS":
+        value = _build_paths()
+    elif name in _LABEL_ATTRS:
+        import labels
+        value = getattr(labels, name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
 
 
 # ==============================================================================
@@ -171,14 +224,176 @@ LABEL_NAME_TO_ID = {v["name"]: k for k, v in BILL_OF_LADING_LABELS.items()}
 # ==============================================================================
 
 def ensure_directories():
-    """确保所有必要的目录存在"""
-    for path in PATHS.values():
-        path.mkdir(parents=True, exist_ok=True)
+    """确保所有必要的目录存在（按父目录 scandir 一次，只创建缺失的目录）"""
+    by_parent = {}
+    for path in _build_paths().values():
+        by_parent.setdefault(path.parent, []).append(path)
+
+    for parent, paths in by_parent.items():
+        try:
+            with os.scandir(parent) as it:
+                existing = {entry.name for entry in it if entry.is_dir()}
+        except FileNotFoundError:
+            existing = set()
+
+        for path in paths:
+            if path.name not in existing:
+                path.mkdir(parents=True, exist_ok=True)
+
+
+def iter_files(root, suffixes):
+    """递归遍历目录，逐个返回文件名以 suffixes 结尾的文件路径 (str)，扩展名不区分大小写
+
+    基于 os.scandir，目录项类型来自 scandir 缓存，无需逐个 stat。
+    目录不存在或无权限读取时跳过（与 Path.glob 一致），不抛出异常。
+    """
+    suffixes = tuple(suffix.lower() for suffix in suffixes)
+    stack = [str(root)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except (FileNotFoundError, PermissionError):
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(suffixes) and entry.is_file():
+                    yield entry.path
+
+
+def list_file_names(directory) -> set:
+    """返回目录下（非递归）所有文件名的集合，目录不存在时返回空集合
+
+    用于批量判断文件是否存在：一次 scandir 代替逐个 exists() 调用。
+    """
+    try:
+        with os.scandir(directory) as it:
+            return {entry.name for entry in it if entry.is_file()}
+    except FileNotFoundError:
+        return set()
+
+
+def write_json(path, data):
+    """将数据序列化为 JSON 并一次性写入文件
+
+    先在内存中完成编码，再以单次 write 写出，避免 json.dump 的逐片段写入。
+    安装了 orjson 时使用 orjson 编码，否则使用 json.dumps(ensure_ascii=False, indent=2)。
+    两者文本不完全一致：浮点数写法可能不同（如 1e-05 写作 0.00001），
+    NaN/Infinity 在 orjson 下写为 null（读回为 None）。
+    """
+    if HAS_ORJSON:
+        buf = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        buf = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(buf)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def json_line(data) -> bytes:
+    """将数据编码为一行紧凑 JSON（含换行符），用于写入 JSONL 文件"""
+    if HAS_ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b"\n"
+
+
+# VLM 返回的 markdown 代码块: ```json ... ```（信息字符串任意，如 JSON、" json" 或为空）
+# 内容贪婪匹配到最后一个 ```，JSON 字符串值中出现 ``` 时不会被截断
+_JSON_FENCE_RE = re.compile(r'```[^\n]*\n(.*)```', re.DOTALL)
+
+
+def strip_json_fence(text: str) -> str:
+    """去除 VLM 回复中的 ```json 代码块标记，没有代码块时原样返回"""
+    match = _JSON_FENCE_RE.search(text)
+    return match.group(1).strip() if match else text
+
+
+# 图片扩展名 -> MIME 类型（VLM 接口接受的图片格式）
+IMAGE_MIME_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+}
+
+
+def image_data_url(image_path) -> str:
+    """将图片文件编码为 base64 data URL
+
+    直接读取文件原始字节，不经过解码再编码。
+    """
+    image_path = Path(image_path)
+    mime = IMAGE_MIME_TYPES.get(image_path.suffix.lower(), "image/png")
+    encoded = base64.b64encode(image_path.read_bytes()).decode('ascii')
+    return f"data:{mime};base64,{encoded}"
+
+
+def image_names_by_stem(directory) -> dict:
+    """返回目录下 VLM 可用图片的 {主文件名: 文件名}，扩展名不区分大小写
+
+    同一主文件名有多种格式时，按 IMAGE_MIME_TYPES 中的顺序优先（png 优先）。
+    """
+    rank = {suffix: i for i, suffix in enumerate(IMAGE_MIME_TYPES)}
+    found = {}
+    for name in list_file_names(directory):
+        stem, suffix = os.path.splitext(name)
+        order = rank.get(suffix.lower())
+        if order is not None and (stem not in found or order < found[stem][0]):
+            found[stem] = (order, name)
+    return {stem: name for stem, (_, name) in found.items()}
+
+
+class RateLimiter:
+    """滑动窗口限流：任意 period 秒内最多放行 max_calls 次，可在多个线程间共享
+
+    period <= 0 时不限流。
+    """
+
+    def __init__(self, max_calls: int, period: float):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """阻塞直到可以发出下一次调用"""
+        if self.period <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                wait = self.period - (now - self._calls[0])
+            time.sleep(wait)
+
+
+# 可视化/文本渲染使用的字体
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(size: int):
+    """加载指定字号的字体（按字号缓存，字体文件不可用时退回 PIL 默认字体）"""
+    # PIL 仅在渲染时需要，不在模块顶部导入；config 不强制依赖任何第三方库（orjson 为可选）
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except OSError:
+        return ImageFont.load_default()
 
 
 def get_path(name: str) -> Path:
     """获取指定名称的路径"""
-    return PATHS.get(name, PROJECT_ROOT / name)
+    return _build_paths().get(name, PROJECT_ROOT / name)
 
 
 # ==============================================================================
@@ -193,3 +408,6 @@ def get_path(name: str) -> Path:
 # 验证配置:
 #   python -c "from config import DEFAULT_CONFIG; print(DEFAULT_CONFIG)"
 #
+# 静态校验 (配置项类型、标签表完整性，已注册为 pre-commit 钩子):
+#   python tools/validate_config.py
+#
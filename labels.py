@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+VLM 数据集创建工具 - 海运单标签定义
+VLM Dataset Creator - Bill of Lading Labels
+
+标签表的唯一定义处，派生映射在首次访问时构建。
+"""
+
+from functools import cached_property
+from types import MappingProxyType
+
+
+# ==============================================================================
+# 海运单标签定义
+# ==============================================================================
+
+BILL_OF_LADING_LABELS = {
+    # 核心角色类
+    0: {"name": "shipper", "name_cn": "托运人", "category": "role"},
+    1: {"name": "consignee", "name_cn": "收货人", "category": "role"},
+    2: {"name": "notify_party", "name_cn": "通知方", "category": "role"},
+
+    # 地理信息类
+    3: {"name": "port_of_loading", "name_cn": "装货港", "category": "geography"},
+    4: {"name": "port_of_discharge", "name_cn": "卸货港", "category": "geography"},
+    5: {"name": "port_of_delivery", "name_cn": "交货港", "category": "geography"},
+    6: {"name": "place_of_delivery", "name_cn": "交货地点", "category": "geography"},
+    7: {"name": "place_of_receipt", "name_cn": "收货地点", "category": "geography"},
+
+    # 运输信息类
+    8: {"name": "vessel", "name_cn": "船名", "category": "transport"},
+    9: {"name": "voyage", "name_cn": "航次", "category": "transport"},
+    10: {"name": "vessel_voyage", "name_cn": "船名航次", "category": "transport"},
+    11: {"name": "container_no", "name_cn": "集装箱号", "category": "transport"},
+    12: {"name": "seal_no", "name_cn": "封号", "category": "transport"},
+
+    # 货物信息类
+    13: {"name": "description_of_goods", "name_cn": "货物描述", "category": "cargo"},
+    14: {"name": "marks_numbers", "name_cn": "唛头和编号", "category": "cargo"},
+    15: {"name": "package", "name_cn": "包装件数", "category": "cargo"},
+    16: {"name": "weight", "name_cn": "重量", "category": "cargo"},
+    17: {"name": "volume", "name_cn": "体积", "category": "cargo"},
+
+    # 编号日期类
+    18: {"name": "bl_no", "name_cn": "提单号", "category": "number"},
+    19: {"name": "freight", "name_cn": "运费", "category": "number"},
+    20: {"name": "date", "name_cn": "日期", "category": "number"},
+    21: {"name": "time", "name_cn": "时间", "category": "number"},
+
+    # 特殊标识类
+    22: {"name": "header", "name_cn": "头部信息", "category": "layout"},
+    23: {"name": "footer", "name_cn": "底部信息", "category": "layout"},
+    24: {"name": "company_logo", "name_cn": "公司标志", "category": "layout"},
+
+    # 费率类
+    25: {"name": "rate", "name_cn": "费率", "category": "rate"},
+    26: {"name": "total", "name_cn": "总计", "category": "rate"},
+
+    # 其他
+    27: {"name": "other", "name_cn": "其他信息", "category": "other"},
+    28: {"name": "abandon", "name_cn": "废弃内容", "category": "other"},
+}
+
+# 标签表只读，防止运行时被意外修改
+BILL_OF_LADING_LABELS = MappingProxyType(BILL_OF_LADING_LABELS)
+
+
+# ==============================================================================
+# 派生映射（延迟构建）
+# ==============================================================================
+
+class _Labels:
+    """标签派生映射，首次访问时构建并缓存"""
+
+    @cached_property
+    def id_to_name(self):
+        """标签ID -> 英文名称（ID 为连续整数 0..N-1，直接按下标索引）"""
+        return tuple(BILL_OF_LADING_LABELS[i]["name"] for i in range(len(BILL_OF_LADING_LABELS)))
+
+    @cached_property
+    def id_to_name_cn(self):
+        """标签ID -> 中文名称"""
+        return tuple(BILL_OF_LADING_LABELS[i]["name_cn"] for i in range(len(BILL_OF_LADING_LABELS)))
+
+    @cached_property
+    def id_to_category(self):
+        """标签ID -> 类别"""
+        return tuple(BILL_OF_LADING_LABELS[i]["category"] for i in range(len(BILL_OF_LADING_LABELS)))
+
+    @cached_property
+    def name_to_id(self):
+        """英文名称 -> 标签ID"""
+        return {name: i for i, name in enumerate(self.id_to_name)}
+
+
+LABELS = _Labels()
+
+_LAZY_ATTRS = {
+    "LABEL_ID_TO_NAME": "id_to_name",
+    "LABEL_ID_TO_NAME_CN": "id_to_name_cn",
+    "LABEL_ID_TO_CATEGORY": "id_to_category",
+    "LABEL_NAME_TO_ID": "name_to_id",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        return getattr(LABELS, _LAZY_ATTRS[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -12,15 +12,14 @@ VLM Dataset Creator - Main Pipeline Runner
 5. 融合生成FUNSD (step5_merge_to_funsd.py)
 """
 
-import os
+import re
 import sys
 import subprocess
 import argparse
 import logging
 from pathlib import Path
-from datetime import datetime
 
-from config import PATHS, DEFAULT_CONFIG, ensure_directories
+from config import PATHS, DEFAULT_CONFIG, ensure_directories, iter_files
 
 # 配置日志
 logging.basicConfig(
@@ -30,6 +29,18 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# API 密钥格式: 至少 20 个字符，不含空白（兼容 OpenAI 格式的各类服务）
+_API_KEY_RE = re.compile(r'^[A-Za-z0-9._\-]{20,}$')
+
+# 支持的文档格式
+DOCUMENT_EXTENSIONS = ('.pdf', '.docx', '.doc', '.xlsx', '.xls')
+
+
+def count_documents(input_dir: Path) -> int:
+    """递归统计目录下支持的文档数量（单次 scandir 遍历）"""
+    return sum(1 for _ in iter_files(input_dir, DOCUMENT_EXTENSIONS))
+
+
 def print_banner():
     """打印横幅"""
     banner = """
@@ -51,8 +62,11 @@ def check_config():
     errors = []
 
     # 检查 API 密钥
-    if not DEFAULT_CONFIG.get("api_key"):
+    api_key = DEFAULT_CONFIG.get("api_key")
+    if not api_key:
         errors.append("未配置 API 密钥 (OPENAI_API_KEY)")
+    elif not _API_KEY_RE.match(api_key):
+        logger.warning("API 密钥格式可疑（过短、含空白或仍为示例值），请检查 OPENAI_API_KEY")
 
     # 检查输入目录
     input_dir = PATHS["input_documents"]
@@ -61,9 +75,7 @@ def check_config():
         logger.warning(f"已创建输入目录: {input_dir}")
 
     # 检查输入文件
-    doc_count = 0
-    for ext in ['.pdf', '.docx', '.doc', '.xlsx', '.xls']:
-        doc_count += len(list(input_dir.glob(f"**/*{ext}")))
+    doc_count = count_documents(input_dir)
 
     if doc_count == 0:
         errors.append(f"输入目录中没有文档文件: {input_dir}")
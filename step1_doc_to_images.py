@@ -9,16 +9,18 @@ Document to Images Converter
 输出: data/02_images/
 """
 
-import os
-import sys
-import io
 import argparse
 import logging
+import os
+import shutil
+import subprocess
+import tempfile
 from pathlib import Path
-from typing import List, Tuple, Optional
-from PIL import Image
+from typing import List, Tuple, Optional, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw
 
-from config import PATHS, DEFAULT_CONFIG, ensure_directories
+from config import PATHS, DEFAULT_CONFIG, ensure_directories, iter_files, load_font
 
 # 配置日志
 logging.basicConfig(
@@ -48,18 +50,67 @@ except ImportError:
     HAS_DOCX = False
 
 
+def _libreoffice_pdf_cmd(doc_path: Path, out_dir: str, profile_root: Path) -> List[str]:
+    """构建 LibreOffice 转 PDF 命令
+
+    每个进程使用 profile_root 下按 PID 区分的用户配置目录：并行进程共用默认配置时，
+    后启动的实例不会执行转换；同一进程内的多次转换复用已初始化的配置，
+    避免每次都重新生成。
+    """
+    profile_uri = (Path(profile_root) / str(os.getpid())).as_uri()
+    return [
+        'libreoffice', '--headless', f'-env:UserInstallation={profile_uri}',
+        '--convert-to', 'pdf', '--outdir', out_dir, str(doc_path)
+    ]
+
+
+# 渲染子进程中打开的 PDF 文档（由 _init_render_worker 设置，每个进程只打开一次）
+_worker_doc = None
+
+
+def _init_render_worker(pdf_path: str):
+    """进程池初始化函数：在子进程中打开一次 PDF，供该进程渲染的所有页复用"""
+    global _worker_doc
+    _worker_doc = fitz.open(pdf_path)
+
+
+def _render_page(args: Tuple[int, float, str]) -> str:
+    """渲染 PDF 单页并直接保存为 PNG（进程池工作函数），返回文件名
+
+    渲染和 PNG 编码都在子进程中完成，只回传文件名，不经管道传输像素数据。
+    """
+    page_num, zoom, output_path = args
+    pix = _worker_doc.load_page(page_num).get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    pix.save(output_path, "PNG")
+    return Path(output_path).name
+
+
 class DocumentToImageConverter:
     """文档转图片转换器"""
 
     SUPPORTED_FORMATS = {'.pdf', '.docx', '.doc', '.xlsx', '.xls'}
 
-    def __init__(self, input_dir: Path, output_dir: Path):
+    OFFICE_FORMATS = {'.docx', '.doc', '.xlsx', '.xls'}
+
+    # 文本渲染降级方案每页最多行数
+    TEXT_PAGE_LINES = 100
+
+    # 含 Word/Excel 文档时的最大并行进程数（每个进程各自启动一个 LibreOffice 实例）
+    OFFICE_MAX_WORKERS = 4
+
+    def __init__(self, input_dir: Path, output_dir: Path, dpi: Optional[int] = None):
         self.input_dir = Path(input_dir)
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
-        self.dpi = DEFAULT_CONFIG.get("image_dpi", 300)
+        # 像素数随 DPI 平方增长：150 DPI 的渲染/编码开销约为 300 DPI 的 1/4，
+        # 但小字号文本的 OCR 精度会下降，默认保持 300
+        self.dpi = dpi or DEFAULT_CONFIG.get("image_dpi", 300)
         self.only_first_page = DEFAULT_CONFIG.get("only_first_page", True)
+        self.num_workers = DEFAULT_CONFIG.get("num_workers", 1)
+        self.page_workers = self.num_workers  # 单个 PDF 按页并行的进程数
+        # LibreOffice 用户配置的根目录；run() 期间为临时目录，结束后删除
+        self.lo_profile_root = Path(tempfile.gettempdir()) / "lo_profiles"
 
         self.stats = {
             "total": 0,
@@ -70,53 +121,79 @@ class DocumentToImageConverter:
 
     def scan_documents(self) -> List[Path]:
         """扫描目录下的所有支持的文档"""
-        documents = []
-        for ext in self.SUPPORTED_FORMATS:
-            documents.extend(self.input_dir.glob(f"**/*{ext}"))
-        documents.sort()
+        documents = sorted(Path(p) for p in iter_files(self.input_dir, self.SUPPORTED_FORMATS))
         self.stats["total"] = len(documents)
         return documents
 
-    def convert_pdf(self, pdf_path: Path) -> List[Tuple[str, Image.Image]]:
-        """将 PDF 转换为图片列表"""
+    def iter_pdf_pages(self, pdf_path: Path) -> Iterator[Tuple[str, "fitz.Pixmap"]]:
+        """逐页渲染 PDF 并依次返回 (页名, Pixmap)
+
+        调用方保存后即可释放该页，内存占用不随页数增长。
+        Pixmap.save(path, "PNG") 由 MuPDF 直接编码，无需先转换为 PIL 图片。
+        """
         if not HAS_PYMUPDF:
             raise ImportError("PyMuPDF 未安装")
 
-        images = []
-        doc = fitz.open(pdf_path)
+        with fitz.open(pdf_path) as doc:
+            yield from self._render_pages(doc)
 
-        try:
-            page_count = doc.page_count
-            pages_to_process = 1 if self.only_first_page else page_count
-
-            for page_num in range(pages_to_process):
-                page = doc.load_page(page_num)
-                # 根据 DPI 计算缩放比例 (72 是 PDF 默认 DPI)
-                zoom = self.dpi / 72
-                mat = fitz.Matrix(zoom, zoom)
-                pix = page.get_pixmap(matrix=mat)
-                img_data = pix.tobytes("png")
-                image = Image.open(io.BytesIO(img_data))
-                images.append((f"page_{page_num + 1}", image))
+    def _pages_to_process(self, doc) -> int:
+        """需要渲染的页数"""
+        return 1 if self.only_first_page else doc.page_count
 
-        finally:
-            doc.close()
+    def _render_pages(self, doc) -> Iterator[Tuple[str, "fitz.Pixmap"]]:
+        """在当前进程中逐页渲染已打开的 PDF"""
+        # 根据 DPI 计算缩放比例 (72 是 PDF 默认 DPI)
+        mat = fitz.Matrix(self.dpi / 72, self.dpi / 72)
+        for page_num in range(self._pages_to_process(doc)):
+            yield f"page_{page_num + 1}", doc.load_page(page_num).get_pixmap(matrix=mat, alpha=False)
 
-        return images
+    def save_pdf_pages(self, pdf_path: Path, stem: str) -> Iterator[str]:
+        """渲染 PDF 各页并保存为 PNG，依次返回保存的文件名
+
+        多页且 page_workers > 1 时按页分发到进程池，子进程渲染、编码并直接写文件，
+        主进程只接收文件名，内存占用不随页数增长。
+        """
+        if not HAS_PYMUPDF:
+            raise ImportError("PyMuPDF 未安装")
+
+        with fitz.open(pdf_path) as doc:
+            pages_to_process = self._pages_to_process(doc)
+            workers = min(self.page_workers, pages_to_process)
+            if workers <= 1:
+                yield from self._save_images(stem, self._render_pages(doc))
+                return
+
+        # 多页 PDF：按页并行渲染并保存，结果按页码顺序返回
+        zoom = self.dpi / 72
+        tasks = [
+            (page_num, zoom, str(self.output_dir / f"{stem}_page_{page_num + 1}.png"))
+            for page_num in range(pages_to_process)
+        ]
+        chunksize = max(1, len(tasks) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker,
+                                 initargs=(str(pdf_path),)) as executor:
+            yield from executor.map(_render_page, tasks, chunksize=chunksize)
+
+    def _save_images(self, stem: str, images: Iterable[Tuple[str, "Image.Image | fitz.Pixmap"]]) -> Iterator[str]:
+        """逐个保存 (页名, 图片)，依次返回保存的文件名"""
+        for page_name, image in images:
+            # 文件名格式: 原文件名_页码.png
+            output_name = f"{stem}_{page_name}.png"
+            image.save(self.output_dir / output_name, "PNG")
+            yield output_name
+
+    def convert_pdf(self, pdf_path: Path) -> List[Tuple[str, "fitz.Pixmap"]]:
+        """将 PDF 转换为图片列表"""
+        return list(self.iter_pdf_pages(pdf_path))
 
     def convert_docx(self, docx_path: Path) -> List[Tuple[str, Image.Image]]:
         """将 Word 文档转换为图片（通过 LibreOffice 或文本渲染）"""
         # 尝试使用 LibreOffice 转换
         try:
-            import subprocess
-            import tempfile
-
             with tempfile.TemporaryDirectory() as tmp_dir:
                 # 先转为 PDF
-                cmd = [
-                    'libreoffice', '--headless', '--convert-to', 'pdf',
-                    '--outdir', tmp_dir, str(docx_path)
-                ]
+                cmd = _libreoffice_pdf_cmd(docx_path, tmp_dir, self.lo_profile_root)
                 result = subprocess.run(cmd, capture_output=True, timeout=60)
 
                 pdf_path = Path(tmp_dir) / f"{docx_path.stem}.pdf"
@@ -134,8 +211,6 @@ class DocumentToImageConverter:
 
     def _render_docx_as_image(self, docx_path: Path) -> List[Tuple[str, Image.Image]]:
         """将 Word 文档文本渲染为图片"""
-        from PIL import ImageDraw, ImageFont
-
         doc = Document(docx_path)
         text_lines = []
         for para in doc.paragraphs:
@@ -149,38 +224,20 @@ class DocumentToImageConverter:
 
         # 创建图片
         font_size = 14
-        line_height = font_size + 6
-        padding = 20
-        max_width = 1200
 
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", font_size)
-        except:
-            font = ImageFont.load_default()
-
-        height = len(text_lines) * line_height + padding * 2
-        image = Image.new('RGB', (max_width, max(height, 100)), 'white')
-        draw = ImageDraw.Draw(image)
+        font = load_font(font_size)
 
-        y = padding
-        for line in text_lines:
-            draw.text((padding, y), line[:150], fill='black', font=font)
-            y += line_height
-
-        return [("page_1", image)]
+        return self._render_text_pages(
+            [line[:150] for line in text_lines], font,
+            line_height=font_size + 6, max_width=1200
+        )
 
     def convert_excel(self, excel_path: Path) -> List[Tuple[str, Image.Image]]:
         """将 Excel 转换为图片"""
         # 同样尝试 LibreOffice
         try:
-            import subprocess
-            import tempfile
-
             with tempfile.TemporaryDirectory() as tmp_dir:
-                cmd = [
-                    'libreoffice', '--headless', '--convert-to', 'pdf',
-                    '--outdir', tmp_dir, str(excel_path)
-                ]
+                cmd = _libreoffice_pdf_cmd(excel_path, tmp_dir, self.lo_profile_root)
                 subprocess.run(cmd, capture_output=True, timeout=60)
 
                 pdf_path = Path(tmp_dir) / f"{excel_path.stem}.pdf"
@@ -195,50 +252,67 @@ class DocumentToImageConverter:
 
     def _render_excel_as_image(self, excel_path: Path) -> List[Tuple[str, Image.Image]]:
         """将 Excel 内容渲染为图片"""
-        from PIL import ImageDraw, ImageFont
-
         if not HAS_OPENPYXL:
             raise ImportError("openpyxl 未安装")
 
-        wb = openpyxl.load_workbook(excel_path)
+        # 只读模式流式读取单元格值，不加载样式；data_only 取公式的计算结果
+        wb = openpyxl.load_workbook(excel_path, read_only=True, data_only=True)
         text_lines = []
 
-        for sheet_name in wb.sheetnames:
-            ws = wb[sheet_name]
-            text_lines.append(f"=== {sheet_name} ===")
-            for row in ws.iter_rows(values_only=True, max_row=50):
-                row_text = " | ".join(str(c) if c else "" for c in row)
-                if row_text.strip():
+        try:
+            for ws in wb.worksheets:
+                text_lines.append(f"=== {ws.title} ===")
+                for row in ws.iter_rows(values_only=True, max_row=50):
+                    # 空行直接跳过，不做逐格 str() 转换
+                    if all(c is None for c in row):
+                        continue
+                    row_text = " | ".join("" if c is None else str(c) for c in row)
                     text_lines.append(row_text[:200])
+        finally:
+            wb.close()
 
         # 渲染
         font_size = 12
-        line_height = font_size + 4
-        padding = 20
-        max_width = 1400
 
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", font_size)
-        except:
-            font = ImageFont.load_default()
+        font = load_font(font_size)
+
+        return self._render_text_pages(text_lines, font, line_height=font_size + 4, max_width=1400)
+
+    def _render_text_pages(self, text_lines: List[str], font, line_height: int,
+                           max_width: int, padding: int = 20) -> List[Tuple[str, Image.Image]]:
+        """将文本行按 TEXT_PAGE_LINES 分页渲染为图片
+
+        避免长文档生成一张超高的大图；only_first_page 时只渲染第一页。
+        """
+        pages = [text_lines[i:i + self.TEXT_PAGE_LINES]
+                 for i in range(0, len(text_lines), self.TEXT_PAGE_LINES)] or [[]]
+        if self.only_first_page:
+            pages = pages[:1]
+
+        images = []
+        for page_num, lines in enumerate(pages, 1):
+            height = len(lines) * line_height + padding * 2
+            image = Image.new('RGB', (max_width, max(height, 100)), 'white')
+            draw = ImageDraw.Draw(image)
+
+            y = padding
+            for line in lines:
+                draw.text((padding, y), line, fill='black', font=font)
+                y += line_height
 
-        height = len(text_lines) * line_height + padding * 2
-        image = Image.new('RGB', (max_width, max(height, 100)), 'white')
-        draw = ImageDraw.Draw(image)
+            images.append((f"page_{page_num}", image))
 
-        y = padding
-        for line in text_lines:
-            draw.text((padding, y), line, fill='black', font=font)
-            y += line_height
+        return images
 
-        return [("page_1", image)]
+    def convert_document(self, doc_path: Path) -> Iterable[Tuple[str, "Image.Image | fitz.Pixmap"]]:
+        """根据文件类型转换文档（PDF 逐页生成 Pixmap，文本渲染返回 PIL 图片列表）
 
-    def convert_document(self, doc_path: Path) -> List[Tuple[str, Image.Image]]:
-        """根据文件类型转换文档"""
+        两种图片对象都支持 save(path, "PNG")。
+        """
         ext = doc_path.suffix.lower()
 
         if ext == '.pdf':
-            return self.convert_pdf(doc_path)
+            return self.iter_pdf_pages(doc_path)
         elif ext in ['.docx', '.doc']:
             return self.convert_docx(doc_path)
         elif ext in ['.xlsx', '.xls']:
@@ -246,32 +320,47 @@ class DocumentToImageConverter:
         else:
             raise ValueError(f"不支持的格式: {ext}")
 
-    def process_single(self, doc_path: Path) -> bool:
-        """处理单个文档"""
+    def convert_single(self, doc_path: Path) -> Optional[int]:
+        """转换并保存单个文档，返回生成的图片数，失败返回 None
+
+        不修改 self.stats，可在子进程中执行。
+        """
         try:
             logger.info(f"处理: {doc_path.name}")
-            images = self.convert_document(doc_path)
+            images_created = 0
+
+            # 逐页保存图片
+            if doc_path.suffix.lower() == '.pdf':
+                output_names = self.save_pdf_pages(doc_path, doc_path.stem)
+            else:
+                output_names = self._save_images(doc_path.stem, self.convert_document(doc_path))
+            for output_name in output_names:
+                logger.info(f"  ✅ 保存: {output_name}")
+                images_created += 1
 
-            if not images:
+            if not images_created:
                 logger.warning(f"  未生成图片: {doc_path.name}")
-                return False
-
-            # 保存图片
-            for page_name, image in images:
-                # 文件名格式: 原文件名_页码.png
-                output_name = f"{doc_path.stem}_{page_name}.png"
-                output_path = self.output_dir / output_name
-                image.save(output_path, "PNG")
-                logger.info(f"  ✅ 保存: {output_name}")
-                self.stats["images_created"] += 1
 
-            self.stats["success"] += 1
-            return True
+            return images_created
 
         except Exception as e:
             logger.error(f"  ❌ 失败: {doc_path.name} - {e}")
+            return None
+
+    def _record_result(self, images_created: Optional[int]) -> bool:
+        """汇总单个文档结果到统计信息"""
+        if images_created is None:
             self.stats["failed"] += 1
             return False
+        if images_created == 0:
+            return False
+        self.stats["success"] += 1
+        self.stats["images_created"] += images_created
+        return True
+
+    def process_single(self, doc_path: Path) -> bool:
+        """处理单个文档"""
+        return self._record_result(self.convert_single(doc_path))
 
     def run(self):
         """运行转换"""
@@ -288,9 +377,30 @@ class DocumentToImageConverter:
 
         logger.info(f"找到 {len(documents)} 个文档\n")
 
-        for i, doc_path in enumerate(documents, 1):
-            logger.info(f"[{i}/{len(documents)}]")
-            self.process_single(doc_path)
+        workers = min(self.num_workers, len(documents))
+        if any(doc.suffix.lower() in self.OFFICE_FORMATS for doc in documents):
+            workers = min(workers, self.OFFICE_MAX_WORKERS)
+
+        # 本次运行的 LibreOffice 配置放在临时目录下，各进程复用，结束后统一删除
+        default_profile_root = self.lo_profile_root
+        self.lo_profile_root = Path(tempfile.mkdtemp(prefix="lo_profiles_"))
+        try:
+            if workers > 1:
+                # 按文档并行；子进程内不再按页开进程池，避免进程数超额
+                logger.info(f"并行进程数: {workers}")
+                self.page_workers = 1
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    results = executor.map(self.convert_single, documents)
+                    for i, images_created in enumerate(results, 1):
+                        logger.info(f"[{i}/{len(documents)}]")
+                        self._record_result(images_created)
+            else:
+                for i, doc_path in enumerate(documents, 1):
+                    logger.info(f"[{i}/{len(documents)}]")
+                    self.process_single(doc_path)
+        finally:
+            shutil.rmtree(self.lo_profile_root, ignore_errors=True)
+            self.lo_profile_root = default_profile_root
 
         # 打印统计
         logger.info("\n" + "=" * 60)
@@ -308,6 +418,7 @@ def main():
     parser = argparse.ArgumentParser(description='Step 1: 文档转图片')
     parser.add_argument('-i', '--input', type=str, help='输入目录')
     parser.add_argument('-o', '--output', type=str, help='输出目录')
+    parser.add_argument('--dpi', type=int, help='渲染 DPI（默认使用配置中的 image_dpi）')
     args = parser.parse_args()
 
     ensure_directories()
@@ -315,7 +426,7 @@ def main():
     input_dir = Path(args.input) if args.input else PATHS["input_documents"]
     output_dir = Path(args.output) if args.output else PATHS["step1_images"]
 
-    converter = DocumentToImageConverter(input_dir, output_dir)
+    converter = DocumentToImageConverter(input_dir, output_dir, dpi=args.dpi)
     converter.run()
 
 
@@ -10,16 +10,19 @@ Image OCR Recognition
 """
 
 import os
-import sys
 import json
+import hashlib
 import argparse
 import logging
+import functools
+import importlib.util
 from pathlib import Path
-from typing import List, Dict, Any, Optional
-from PIL import Image, ImageDraw, ImageFont
+from typing import List, Dict, Any, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw
 import numpy as np
 
-from config import PATHS, DEFAULT_CONFIG, ensure_directories
+from config import PATHS, DEFAULT_CONFIG, ensure_directories, iter_files, write_json, load_font, available_cpu_count
 
 # 配置日志
 logging.basicConfig(
@@ -28,29 +31,56 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 检查 PaddleOCR
-try:
-    from paddleocr import PaddleOCR
-    HAS_PADDLEOCR = True
-except ImportError:
-    HAS_PADDLEOCR = False
+# 检查 PaddleOCR（只探测是否安装，真正导入推迟到首次识别时）
+HAS_PADDLEOCR = importlib.util.find_spec("paddleocr") is not None
+if not HAS_PADDLEOCR:
     logger.warning("PaddleOCR 未安装。请运行: pip install paddlepaddle paddleocr")
 
 
+@functools.lru_cache(maxsize=None)
+def _get_ocr_engine(lang: str, options: Tuple[Tuple[str, Any], ...] = ()):
+    """按语言和推理参数获取 PaddleOCR 实例（首次调用时导入并加载模型，之后复用）
+
+    options 为 (参数名, 值) 元组，直接传给 PaddleOCR 构造函数；使用元组以便作为缓存键。
+    """
+    from paddleocr import PaddleOCR
+    logger.info(f"初始化 PaddleOCR (语言: {lang}, 参数: {dict(options)})")
+    return PaddleOCR(
+        use_angle_cls=True,
+        lang=lang,
+        show_log=False,
+        **dict(options)
+    )
+
+
 class OCRProcessor:
     """OCR 处理器"""
 
-    def __init__(self, input_dir: Path, output_dir: Path, vis_dir: Optional[Path] = None):
+    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.tif', '.webp')
+
+    def __init__(
+        self,
+        input_dir: Path,
+        output_dir: Path,
+        vis_dir: Optional[Path] = None,
+        num_workers: Optional[int] = None,
+        cache_dir: Optional[Path] = None
+    ):
         self.input_dir = Path(input_dir)
         self.output_dir = Path(output_dir)
         self.vis_dir = Path(vis_dir) if vis_dir else None
+        self.cache_dir = Path(cache_dir) if cache_dir else None
 
         self.output_dir.mkdir(parents=True, exist_ok=True)
         if self.vis_dir:
             self.vis_dir.mkdir(parents=True, exist_ok=True)
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
 
         self.lang = DEFAULT_CONFIG.get("ocr_lang", "ch")
-        self.ocr = None  # 延迟初始化
+        # 每个进程各自加载一份模型，内存占用随进程数增长
+        self.num_workers = num_workers or DEFAULT_CONFIG.get("ocr_workers", 1)
+        self.ocr_options = self._build_ocr_options()
 
         self.stats = {
             "total": 0,
@@ -59,67 +89,97 @@ class OCRProcessor:
             "total_text_boxes": 0
         }
 
+    def _build_ocr_options(self) -> Tuple[Tuple[str, Any], ...]:
+        """根据配置构建 PaddleOCR 推理参数"""
+        # 未指定线程数时按进程数均分 CPU 核心，避免多进程识别时线程超额
+        cpu_threads = DEFAULT_CONFIG.get("ocr_cpu_threads") or max(1, available_cpu_count() // self.num_workers)
+        options = {
+            "enable_mkldnn": DEFAULT_CONFIG.get("ocr_enable_mkldnn", False),
+            "cpu_threads": cpu_threads,
+            "precision": DEFAULT_CONFIG.get("ocr_precision", "fp32"),
+        }
+        # 自定义模型目录（如官方 INT8 量化模型），未配置时使用 PaddleOCR 默认模型
+        for key in ("det_model_dir", "rec_model_dir", "cls_model_dir"):
+            model_dir = DEFAULT_CONFIG.get(f"ocr_{key}")
+            if model_dir:
+                options[key] = str(model_dir)
+        return tuple(sorted(options.items()))
+
     def _init_ocr(self):
-        """初始化 PaddleOCR"""
+        """获取 PaddleOCR 实例（延迟初始化，同一进程内复用）"""
         if not HAS_PADDLEOCR:
             raise ImportError("PaddleOCR 未安装")
 
-        if self.ocr is None:
-            logger.info(f"初始化 PaddleOCR (语言: {self.lang})")
-            self.ocr = PaddleOCR(
-                use_angle_cls=True,
-                lang=self.lang,
-                show_log=False
-            )
+        return _get_ocr_engine(self.lang, self.ocr_options)
 
     def scan_images(self) -> List[Path]:
         """扫描目录下的所有图片"""
-        images = []
-        for ext in ['*.png', '*.jpg', '*.jpeg', '*.bmp', '*.tiff']:
-            images.extend(self.input_dir.glob(f"**/{ext}"))
-        images.sort()
+        images = sorted(Path(p) for p in iter_files(self.input_dir, self.IMAGE_EXTENSIONS))
         self.stats["total"] = len(images)
         return images
 
+    def _cache_path(self, image_path: Path) -> Path:
+        """按图片内容计算缓存文件路径"""
+        digest = hashlib.sha256(image_path.read_bytes())
+        # 识别结果还取决于语言和推理参数，一并计入缓存键
+        digest.update(repr((self.lang, self.ocr_options)).encode('utf-8'))
+        return self.cache_dir / f"{digest.hexdigest()}.json"
+
     def ocr_image(self, image_path: Path) -> List[Dict[str, Any]]:
-        """对单张图片进行 OCR 识别"""
-        self._init_ocr()
-
-        result = self.ocr.ocr(str(image_path), cls=True)
-
-        ocr_results = []
-        if result and result[0]:
-            for idx, line in enumerate(result[0]):
-                box = line[0]  # [[x1,y1], [x2,y2], [x3,y3], [x4,y4]]
-                text = line[1][0]
-                confidence = float(line[1][1])
-
-                # 计算边界框 [x_min, y_min, x_max, y_max]
-                points = np.array(box)
-                x_min = int(min(points[:, 0]))
-                y_min = int(min(points[:, 1]))
-                x_max = int(max(points[:, 0]))
-                y_max = int(max(points[:, 1]))
-
-                ocr_results.append({
-                    "id": idx,
-                    "text": text,
-                    "box": [x_min, y_min, x_max, y_max],
-                    "polygon": [[int(p[0]), int(p[1])] for p in box],
-                    "confidence": round(confidence, 4)
-                })
+        """对单张图片进行 OCR 识别（启用缓存时，内容相同的图片只识别一次）"""
+        if not self.cache_dir:
+            return self._run_ocr(image_path)
+
+        cache_path = self._cache_path(image_path)
+        try:
+            return json.loads(cache_path.read_bytes())
+        except (FileNotFoundError, ValueError):
+            pass
 
+        ocr_results = self._run_ocr(image_path)
+
+        # 先写临时文件再替换，避免并行进程读到写了一半的缓存
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        write_json(tmp_path, ocr_results)
+        os.replace(tmp_path, cache_path)
         return ocr_results
 
+    def _run_ocr(self, image_path: Path) -> List[Dict[str, Any]]:
+        """调用 PaddleOCR 识别单张图片"""
+        ocr = self._init_ocr()
+
+        result = ocr.ocr(str(image_path), cls=True)
+
+        if not (result and result[0]):
+            return []
+
+        lines = result[0]
+
+        # 所有文本框的四点坐标 [[x1,y1], [x2,y2], [x3,y3], [x4,y4]] 组成 (N, 4, 2) 数组，
+        # 一次性计算边界框 [x_min, y_min, x_max, y_max] 和整数多边形
+        polygons = np.asarray([line[0] for line in lines], dtype=np.float64)
+        mins = polygons.min(axis=1).astype(int).tolist()
+        maxs = polygons.max(axis=1).astype(int).tolist()
+        int_polygons = polygons.astype(int).tolist()
+
+        return [
+            {
+                "id": idx,
+                "text": line[1][0],
+                "box": [x_min, y_min, x_max, y_max],
+                "polygon": polygon,
+                "confidence": round(float(line[1][1]), 4)
+            }
+            for idx, (line, (x_min, y_min), (x_max, y_max), polygon)
+            in enumerate(zip(lines, mins, maxs, int_polygons))
+        ]
+
     def draw_ocr_results(self, image_path: Path, ocr_results: List[Dict], output_path: Path):
         """在图片上绘制 OCR 结果"""
         image = Image.open(image_path).convert("RGB")
         draw = ImageDraw.Draw(image)
 
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 12)
-        except:
-            font = ImageFont.load_default()
+        font = load_font(12)
 
         for item in ocr_results:
             box = item["box"]
@@ -131,10 +191,13 @@ class OCRProcessor:
             # 标注ID
             draw.text((box[0], box[1] - 15), str(text_id), fill="blue", font=font)
 
-        image.save(output_path)
+        image.save(output_path, compress_level=DEFAULT_CONFIG.get("vis_compress_level", 1))
 
-    def process_single(self, image_path: Path) -> bool:
-        """处理单张图片"""
+    def ocr_single(self, image_path: Path) -> Optional[int]:
+        """处理单张图片，返回识别到的文本框数，失败返回 None
+
+        不修改 self.stats，可在子进程中执行。
+        """
         try:
             logger.info(f"处理: {image_path.name}")
 
@@ -155,8 +218,7 @@ class OCRProcessor:
             # 保存 JSON 结果
             output_name = f"{image_path.stem}.json"
             output_path = self.output_dir / output_name
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(output_data, f, ensure_ascii=False, indent=2)
+            write_json(output_path, output_data)
 
             logger.info(f"  ✅ 识别到 {len(ocr_results)} 个文本框 -> {output_name}")
 
@@ -166,14 +228,24 @@ class OCRProcessor:
                 self.draw_ocr_results(image_path, ocr_results, vis_path)
                 logger.info(f"  📊 可视化: {vis_path.name}")
 
-            self.stats["success"] += 1
-            self.stats["total_text_boxes"] += len(ocr_results)
-            return True
+            return len(ocr_results)
 
         except Exception as e:
             logger.error(f"  ❌ 失败: {image_path.name} - {e}")
+            return None
+
+    def _record_result(self, box_count: Optional[int]) -> bool:
+        """汇总单张图片结果到统计信息"""
+        if box_count is None:
             self.stats["failed"] += 1
             return False
+        self.stats["success"] += 1
+        self.stats["total_text_boxes"] += box_count
+        return True
+
+    def process_single(self, image_path: Path) -> bool:
+        """处理单张图片"""
+        return self._record_result(self.ocr_single(image_path))
 
     def run(self):
         """运行 OCR 处理"""
@@ -192,9 +264,19 @@ class OCRProcessor:
 
         logger.info(f"找到 {len(images)} 张图片\n")
 
-        for i, image_path in enumerate(images, 1):
-            logger.info(f"[{i}/{len(images)}]")
-            self.process_single(image_path)
+        workers = min(self.num_workers, len(images))
+        if workers > 1:
+            # 各图片互相独立，按进程并行识别；模型在进程内首次未命中缓存时加载一次
+            logger.info(f"并行进程数: {workers}")
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(self.ocr_single, images)
+                for i, box_count in enumerate(results, 1):
+                    logger.info(f"[{i}/{len(images)}]")
+                    self._record_result(box_count)
+        else:
+            for i, image_path in enumerate(images, 1):
+                logger.info(f"[{i}/{len(images)}]")
+                self.process_single(image_path)
 
         # 打印统计
         logger.info("\n" + "=" * 60)
@@ -213,6 +295,8 @@ def main():
     parser.add_argument('-i', '--input', type=str, help='输入目录')
     parser.add_argument('-o', '--output', type=str, help='输出目录')
     parser.add_argument('-v', '--visualize', action='store_true', help='生成可视化结果')
+    parser.add_argument('-j', '--workers', type=int, help='并行进程数（默认使用配置中的 ocr_workers）')
+    parser.add_argument('--no-cache', action='store_true', help='不使用 OCR 结果缓存')
     args = parser.parse_args()
 
     ensure_directories()
@@ -220,8 +304,10 @@ def main():
     input_dir = Path(args.input) if args.input else PATHS["step1_images"]
     output_dir = Path(args.output) if args.output else PATHS["step2_ocr"]
     vis_dir = PATHS["visualizations"] / "ocr" if args.visualize else None
+    use_cache = DEFAULT_CONFIG.get("ocr_cache", True) and not args.no_cache
+    cache_dir = PATHS["ocr_cache"] if use_cache else None
 
-    processor = OCRProcessor(input_dir, output_dir, vis_dir)
+    processor = OCRProcessor(input_dir, output_dir, vis_dir, num_workers=args.workers, cache_dir=cache_dir)
     processor.run()
 
 
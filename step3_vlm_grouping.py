@@ -14,20 +14,18 @@ VLM Text Grouping Annotation
   - data/04_vlm_grouping/ (分组结果)
 """
 
-import os
-import sys
 import json
-import base64
 import argparse
 import logging
-import time
+import threading
 from pathlib import Path
-from typing import List, Dict, Any, Optional
-from io import BytesIO
-import concurrent.futures
-from PIL import Image
+from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
 
-from config import PATHS, DEFAULT_CONFIG, ensure_directories
+from config import (
+    PATHS, DEFAULT_CONFIG, ensure_directories, list_file_names, write_json,
+    image_data_url, image_names_by_stem, strip_json_fence, RateLimiter
+)
 
 # 配置日志
 logging.basicConfig(
@@ -98,8 +96,12 @@ class VLMGroupingProcessor:
         self.model_name = DEFAULT_CONFIG.get("model_name")
         self.batch_size = DEFAULT_CONFIG.get("batch_size", 5)
         self.interval = DEFAULT_CONFIG.get("interval", 15)
+        self.max_retries = DEFAULT_CONFIG.get("vlm_max_retries", 5)
+        self.timeout = DEFAULT_CONFIG.get("vlm_timeout", 120)
 
         self.client = None
+        self._client_lock = threading.Lock()
+        self.rate_limiter = RateLimiter(self.batch_size, self.interval)
 
         self.stats = {
             "total": 0,
@@ -115,38 +117,39 @@ class VLMGroupingProcessor:
         if not self.api_key:
             raise ValueError("未配置 API 密钥")
 
-        if self.client is None:
-            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-
-    def _encode_image(self, image_path: Path) -> str:
-        """将图片编码为 base64"""
-        with Image.open(image_path) as img:
-            buffered = BytesIO()
-            img.save(buffered, format="PNG")
-            return base64.b64encode(buffered.getvalue()).decode("utf-8")
+        # 并发任务共享同一个客户端，加锁避免重复创建
+        with self._client_lock:
+            if self.client is None:
+                # 429/5xx/超时由客户端按指数退避（带抖动）自动重试，不会因瞬时限流丢弃整页
+                self.client = OpenAI(
+                    api_key=self.api_key,
+                    base_url=self.base_url,
+                    max_retries=self.max_retries,
+                    timeout=self.timeout
+                )
 
     def scan_tasks(self) -> List[Dict[str, Path]]:
         """扫描待处理任务"""
         tasks = []
-        for ocr_file in self.ocr_dir.glob("*.json"):
+        # 每个目录只列举一次，之后用集合判断文件是否存在
+        image_names = image_names_by_stem(self.image_dir)
+        done_names = list_file_names(self.output_dir)
+
+        for ocr_name in sorted(list_file_names(self.ocr_dir)):
+            if not ocr_name.endswith(".json"):
+                continue
+
             # 查找对应的图片
-            stem = ocr_file.stem
-            image_path = None
-            for ext in ['.png', '.jpg', '.jpeg']:
-                candidate = self.image_dir / f"{stem}{ext}"
-                if candidate.exists():
-                    image_path = candidate
-                    break
-
-            if image_path:
-                # 检查是否已处理
-                output_path = self.output_dir / f"{stem}.json"
-                if not output_path.exists():
-                    tasks.append({
-                        "image": image_path,
-                        "ocr": ocr_file,
-                        "output": output_path
-                    })
+            stem = ocr_name[:-len(".json")]
+            image_name = image_names.get(stem)
+
+            # 跳过已处理的任务
+            if image_name and ocr_name not in done_names:
+                tasks.append({
+                    "image": self.image_dir / image_name,
+                    "ocr": self.ocr_dir / ocr_name,
+                    "output": self.output_dir / ocr_name
+                })
 
         self.stats["total"] = len(tasks)
         return tasks
@@ -162,8 +165,10 @@ class VLMGroupingProcessor:
         ocr_info = "\n".join(ocr_info_lines)
 
         prompt = GROUPING_PROMPT.format(ocr_info=ocr_info)
-        base64_image = self._encode_image(image_path)
+        image_url = image_data_url(image_path)
 
+        # 只有真正发出的请求占用限流额度
+        self.rate_limiter.acquire()
         response = self.client.chat.completions.create(
             model=self.model_name,
             messages=[
@@ -172,7 +177,7 @@ class VLMGroupingProcessor:
                     "content": [
                         {
                             "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{base64_image}"}
+                            "image_url": {"url": image_url}
                         },
                         {"type": "text", "text": prompt}
                     ]
@@ -183,15 +188,16 @@ class VLMGroupingProcessor:
 
         result_text = response.choices[0].message.content.strip()
 
-        # 解析 JSON
-        if result_text.startswith("```"):
-            lines = result_text.split("\n")
-            result_text = "\n".join(lines[1:-1])
+        # 解析 JSON（去除 ```json 代码块标记）
+        result_text = strip_json_fence(result_text)
 
         return json.loads(result_text)
 
-    def process_single(self, task: Dict[str, Path]) -> bool:
-        """处理单个任务"""
+    def group_single(self, task: Dict[str, Path]) -> Optional[int]:
+        """处理单个任务，返回分组数，失败返回 None
+
+        不修改 self.stats，可在线程池中并发执行。
+        """
         try:
             image_path = task["image"]
             ocr_path = task["ocr"]
@@ -216,18 +222,27 @@ class VLMGroupingProcessor:
             }
 
             # 保存结果
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(output_data, f, ensure_ascii=False, indent=2)
+            write_json(output_path, output_data)
 
-            logger.info(f"  ✅ 分组完成: {len(groups)} 个组")
-            self.stats["success"] += 1
-            self.stats["total_groups"] += len(groups)
-            return True
+            logger.info(f"  ✅ 分组完成: {image_path.name} {len(groups)} 个组")
+            return len(groups)
 
         except Exception as e:
             logger.error(f"  ❌ 失败: {task['image'].name} - {e}")
+            return None
+
+    def _record_result(self, group_count: Optional[int]) -> bool:
+        """汇总单个任务结果到统计信息"""
+        if group_count is None:
             self.stats["failed"] += 1
             return False
+        self.stats["success"] += 1
+        self.stats["total_groups"] += group_count
+        return True
+
+    def process_single(self, task: Dict[str, Path]) -> bool:
+        """处理单个任务"""
+        return self._record_result(self.group_single(task))
 
     def run(self):
         """运行分组处理"""
@@ -247,15 +262,13 @@ class VLMGroupingProcessor:
 
         logger.info(f"找到 {len(tasks)} 个待处理任务\n")
 
-        # 批量处理
-        for i, task in enumerate(tasks, 1):
-            logger.info(f"[{i}/{len(tasks)}]")
-            self.process_single(task)
-
-            # 批次间隔
-            if i % self.batch_size == 0 and i < len(tasks):
-                logger.info(f"⏳ 等待 {self.interval} 秒...")
-                time.sleep(self.interval)
+        # 最多 batch_size 个请求同时进行，且任意 interval 秒内最多发出 batch_size 个请求；
+        # 请求结束即可补发下一个，不必等整批完成
+        logger.info(f"并发请求数: {self.batch_size}，限流: 每 {self.interval} 秒 {self.batch_size} 个请求")
+        with ThreadPoolExecutor(max_workers=self.batch_size) as executor:
+            for i, group_count in enumerate(executor.map(self.group_single, tasks), 1):
+                logger.info(f"[{i}/{len(tasks)}]")
+                self._record_result(group_count)
 
         # 打印统计
         logger.info("\n" + "=" * 60)
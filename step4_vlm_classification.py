@@ -15,18 +15,20 @@ VLM Keyword Classification Annotation
 """
 
 import os
-import sys
 import json
-import base64
+import hashlib
 import argparse
 import logging
-import time
+import threading
 from pathlib import Path
-from typing import List, Dict, Any, Optional
-from io import BytesIO
-from PIL import Image
+from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
 
-from config import PATHS, DEFAULT_CONFIG, BILL_OF_LADING_LABELS, LABEL_ID_TO_NAME, ensure_directories
+from config import (
+    PATHS, DEFAULT_CONFIG, ensure_directories, list_file_names, write_json,
+    image_data_url, image_names_by_stem, strip_json_fence, RateLimiter
+)
+from labels import LABEL_ID_TO_NAME, LABEL_ID_TO_NAME_CN
 
 # 配置日志
 logging.basicConfig(
@@ -45,10 +47,10 @@ except ImportError:
 
 # 生成标签说明
 def _generate_label_description():
-    lines = []
-    for label_id, info in BILL_OF_LADING_LABELS.items():
-        lines.append(f"{label_id}. {info['name']} ({info['name_cn']})")
-    return "\n".join(lines)
+    return "\n".join(
+        f"{label_id}. {name} ({name_cn})"
+        for label_id, (name, name_cn) in enumerate(zip(LABEL_ID_TO_NAME, LABEL_ID_TO_NAME_CN))
+    )
 
 
 CLASSIFICATION_PROMPT = """## 任务：海运单关键字分类
@@ -78,14 +80,18 @@ class VLMClassificationProcessor:
         image_dir: Path,
         ocr_dir: Path,
         grouping_dir: Path,
-        output_dir: Path
+        output_dir: Path,
+        cache_dir: Optional[Path] = None
     ):
         self.image_dir = Path(image_dir)
         self.ocr_dir = Path(ocr_dir)
         self.grouping_dir = Path(grouping_dir)
         self.output_dir = Path(output_dir)
+        self.cache_dir = Path(cache_dir) if cache_dir else None
 
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
 
         # API 配置
         self.api_key = DEFAULT_CONFIG.get("api_key")
@@ -93,9 +99,20 @@ class VLMClassificationProcessor:
         self.model_name = DEFAULT_CONFIG.get("model_name")
         self.batch_size = DEFAULT_CONFIG.get("batch_size", 5)
         self.interval = DEFAULT_CONFIG.get("interval", 15)
+        self.max_retries = DEFAULT_CONFIG.get("vlm_max_retries", 5)
+        self.timeout = DEFAULT_CONFIG.get("vlm_timeout", 120)
+        self.json_mode = DEFAULT_CONFIG.get("vlm_json_mode", False)
 
         self.client = None
+        self._client_lock = threading.Lock()
+        self.rate_limiter = RateLimiter(self.batch_size, self.interval)
         self.label_description = _generate_label_description()
+        # 提示词中只有分组信息随任务变化，其余部分（含标签说明）预先格式化并拆成前后两段
+        self.prompt_head, _, self.prompt_tail = CLASSIFICATION_PROMPT.format(
+            label_description=self.label_description,
+            grouped_info="\0"
+        ).partition("\0")
+        self.label_mapping = {str(k): name for k, name in enumerate(LABEL_ID_TO_NAME)}
 
         self.stats = {
             "total": 0,
@@ -109,49 +126,47 @@ class VLMClassificationProcessor:
         if not self.api_key:
             raise ValueError("未配置 API 密钥")
 
-        if self.client is None:
-            self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-
-    def _encode_image(self, image_path: Path) -> str:
-        with Image.open(image_path) as img:
-            buffered = BytesIO()
-            img.save(buffered, format="PNG")
-            return base64.b64encode(buffered.getvalue()).decode("utf-8")
+        # 并发任务共享同一个客户端，加锁避免重复创建
+        with self._client_lock:
+            if self.client is None:
+                # 429/5xx/超时由客户端按指数退避（带抖动）自动重试，不会因瞬时限流丢弃整页
+                self.client = OpenAI(
+                    api_key=self.api_key,
+                    base_url=self.base_url,
+                    max_retries=self.max_retries,
+                    timeout=self.timeout
+                )
 
     def scan_tasks(self) -> List[Dict[str, Path]]:
         """扫描待处理任务"""
         tasks = []
-        for grouping_file in self.grouping_dir.glob("*.json"):
-            stem = grouping_file.stem
+        # 每个目录只列举一次，之后用集合判断文件是否存在
+        image_names = image_names_by_stem(self.image_dir)
+        ocr_names = list_file_names(self.ocr_dir)
+        done_names = list_file_names(self.output_dir)
+
+        for grouping_name in sorted(list_file_names(self.grouping_dir)):
+            if not grouping_name.endswith(".json"):
+                continue
+            stem = grouping_name[:-len(".json")]
 
             # 查找图片
-            image_path = None
-            for ext in ['.png', '.jpg', '.jpeg']:
-                candidate = self.image_dir / f"{stem}{ext}"
-                if candidate.exists():
-                    image_path = candidate
-                    break
-
-            # 查找 OCR 文件
-            ocr_path = self.ocr_dir / f"{stem}.json"
-
-            if image_path and ocr_path.exists():
-                output_path = self.output_dir / f"{stem}.json"
-                if not output_path.exists():
-                    tasks.append({
-                        "image": image_path,
-                        "ocr": ocr_path,
-                        "grouping": grouping_file,
-                        "output": output_path
-                    })
+            image_name = image_names.get(stem)
+
+            # OCR 文件与分组文件同名；跳过已处理的任务
+            if image_name and grouping_name in ocr_names and grouping_name not in done_names:
+                tasks.append({
+                    "image": self.image_dir / image_name,
+                    "ocr": self.ocr_dir / grouping_name,
+                    "grouping": self.grouping_dir / grouping_name,
+                    "output": self.output_dir / grouping_name
+                })
 
         self.stats["total"] = len(tasks)
         return tasks
 
     def call_vlm(self, image_path: Path, ocr_data: Dict, grouping_data: Dict) -> Dict[str, int]:
-        """调用 VLM 进行分类"""
-        self._init_client()
-
+        """调用 VLM 进行分类（启用缓存时，图片和提示词都相同的请求只发送一次）"""
         # 构建分组信息
         text_boxes = {box["id"]: box for box in ocr_data.get("text_boxes", [])}
         groups = grouping_data.get("groups", [])
@@ -167,13 +182,59 @@ class VLMClassificationProcessor:
 
         grouped_info = "\n".join(grouped_info_lines)
 
-        prompt = CLASSIFICATION_PROMPT.format(
-            label_description=self.label_description,
-            grouped_info=grouped_info
-        )
+        prompt = f"{self.prompt_head}{grouped_info}{self.prompt_tail}"
+
+        if not self.cache_dir:
+            return self._request_vlm(image_path, prompt)
+
+        cache_path = self._cache_path(image_path, prompt)
+        try:
+            return json.loads(cache_path.read_bytes())
+        except (FileNotFoundError, ValueError):
+            pass
+
+        classifications = self._request_vlm(image_path, prompt)
+        if not self._is_valid_classification(classifications):
+            # 格式异常的回复不写入缓存，下次运行重新请求
+            return classifications
+
+        # 先写临时文件再替换，避免并发任务读到写了一半的缓存
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        write_json(tmp_path, classifications)
+        os.replace(tmp_path, cache_path)
+        return classifications
+
+    @staticmethod
+    def _is_valid_classification(classifications) -> bool:
+        """回复是否为 {组ID: 标签ID} 字典，且键和值都能转换为整数"""
+        if not isinstance(classifications, dict):
+            return False
+        try:
+            for group_id, label_id in classifications.items():
+                int(group_id)
+                int(label_id)
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    def _cache_path(self, image_path: Path, prompt: str) -> Path:
+        """按图片内容和请求参数计算缓存文件路径"""
+        digest = hashlib.sha256(image_path.read_bytes())
+        # 分类依赖图片上下文，只在图片、提示词和模型都相同时复用结果
+        digest.update(repr((self.model_name, self.json_mode, prompt)).encode('utf-8'))
+        return self.cache_dir / f"{digest.hexdigest()}.json"
+
+    def _request_vlm(self, image_path: Path, prompt: str) -> Dict[str, int]:
+        """发送分类请求并解析返回的 JSON"""
+        self._init_client()
 
-        base64_image = self._encode_image(image_path)
+        image_url = image_data_url(image_path)
 
+        # JSON 模式下接口保证返回合法的 JSON 对象，无需再剥离代码块
+        extra_args = {"response_format": {"type": "json_object"}} if self.json_mode else {}
+
+        # 只有真正发出的请求占用限流额度
+        self.rate_limiter.acquire()
         response = self.client.chat.completions.create(
             model=self.model_name,
             messages=[
@@ -182,26 +243,29 @@ class VLMClassificationProcessor:
                     "content": [
                         {
                             "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{base64_image}"}
+                            "image_url": {"url": image_url}
                         },
                         {"type": "text", "text": prompt}
                     ]
                 }
             ],
-            max_tokens=4096
+            max_tokens=4096,
+            **extra_args
         )
 
         result_text = response.choices[0].message.content.strip()
 
-        # 解析 JSON
-        if result_text.startswith("```"):
-            lines = result_text.split("\n")
-            result_text = "\n".join(lines[1:-1])
+        if not self.json_mode:
+            # 解析 JSON（去除 ```json 代码块标记）
+            result_text = strip_json_fence(result_text)
 
         return json.loads(result_text)
 
-    def process_single(self, task: Dict[str, Path]) -> bool:
-        """处理单个任务"""
+    def classify_single(self, task: Dict[str, Path]) -> Optional[int]:
+        """处理单个任务，返回分类的组数，失败返回 None
+
+        不修改 self.stats，可在线程池中并发执行。
+        """
         try:
             image_path = task["image"]
             ocr_path = task["ocr"]
@@ -225,23 +289,30 @@ class VLMClassificationProcessor:
                 "ocr_file": ocr_path.name,
                 "grouping_file": grouping_path.name,
                 "classifications": classifications,
-                "label_mapping": {
-                    str(k): v["name"] for k, v in BILL_OF_LADING_LABELS.items()
-                }
+                "label_mapping": self.label_mapping
             }
 
             # 保存结果
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(output_data, f, ensure_ascii=False, indent=2)
+            write_json(output_path, output_data)
 
-            logger.info(f"  ✅ 分类完成: {len(classifications)} 个组")
-            self.stats["success"] += 1
-            return True
+            logger.info(f"  ✅ 分类完成: {image_path.name} {len(classifications)} 个组")
+            return len(classifications)
 
         except Exception as e:
             logger.error(f"  ❌ 失败: {task['image'].name} - {e}")
+            return None
+
+    def _record_result(self, classified_count: Optional[int]) -> bool:
+        """汇总单个任务结果到统计信息"""
+        if classified_count is None:
             self.stats["failed"] += 1
             return False
+        self.stats["success"] += 1
+        return True
+
+    def process_single(self, task: Dict[str, Path]) -> bool:
+        """处理单个任务"""
+        return self._record_result(self.classify_single(task))
 
     def run(self):
         """运行分类处理"""
@@ -261,13 +332,13 @@ class VLMClassificationProcessor:
 
         logger.info(f"找到 {len(tasks)} 个待处理任务\n")
 
-        for i, task in enumerate(tasks, 1):
-            logger.info(f"[{i}/{len(tasks)}]")
-            self.process_single(task)
-
-            if i % self.batch_size == 0 and i < len(tasks):
-                logger.info(f"⏳ 等待 {self.interval} 秒...")
-                time.sleep(self.interval)
+        # 最多 batch_size 个请求同时进行，且任意 interval 秒内最多发出 batch_size 个请求；
+        # 请求结束即可补发下一个，不必等整批完成
+        logger.info(f"并发请求数: {self.batch_size}，限流: 每 {self.interval} 秒 {self.batch_size} 个请求")
+        with ThreadPoolExecutor(max_workers=self.batch_size) as executor:
+            for i, classified_count in enumerate(executor.map(self.classify_single, tasks), 1):
+                logger.info(f"[{i}/{len(tasks)}]")
+                self._record_result(classified_count)
 
         # 打印统计
         logger.info("\n" + "=" * 60)
@@ -286,6 +357,8 @@ def main():
     parser.add_argument('--ocr-dir', type=str, help='OCR结果目录')
     parser.add_argument('--grouping-dir', type=str, help='分组结果目录')
     parser.add_argument('-o', '--output', type=str, help='输出目录')
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction,
+                        help='是否使用分类结果缓存 temp/vlm_cache（默认使用配置中的 vlm_cache）')
     args = parser.parse_args()
 
     ensure_directories()
@@ -294,8 +367,10 @@ def main():
     ocr_dir = Path(args.ocr_dir) if args.ocr_dir else PATHS["step2_ocr"]
     grouping_dir = Path(args.grouping_dir) if args.grouping_dir else PATHS["step3_grouping"]
     output_dir = Path(args.output) if args.output else PATHS["step4_classification"]
+    use_cache = DEFAULT_CONFIG.get("vlm_cache", False) if args.cache is None else args.cache
+    cache_dir = PATHS["vlm_cache"] if use_cache else None
 
-    processor = VLMClassificationProcessor(image_dir, ocr_dir, grouping_dir, output_dir)
+    processor = VLMClassificationProcessor(image_dir, ocr_dir, grouping_dir, output_dir, cache_dir=cache_dir)
     processor.run()
 
 
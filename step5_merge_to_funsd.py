@@ -15,17 +15,19 @@ Merge to FUNSD Format
   - data/06_funsd_output/ (FUNSD格式数据)
 """
 
-import os
-import sys
 import json
 import shutil
 import argparse
 import logging
+import traceback
 from pathlib import Path
-from typing import List, Dict, Any, Optional
-from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Optional, Tuple
+import numpy as np
+from PIL import Image, ImageDraw
 
-from config import PATHS, BILL_OF_LADING_LABELS, LABEL_ID_TO_NAME, ensure_directories
+from config import PATHS, DEFAULT_CONFIG, ensure_directories, list_file_names, write_json, load_font, image_names_by_stem, json_line
+from labels import LABEL_ID_TO_NAME, LABEL_ID_TO_CATEGORY
 
 # 配置日志
 logging.basicConfig(
@@ -48,6 +50,27 @@ FUNSD_LABEL_MAPPING = {
     "other": "other"
 }
 
+# 标签ID -> FUNSD 标签（模块加载时按类别预先计算，按ID直接索引）
+FUNSD_LABEL_BY_ID = tuple(
+    FUNSD_LABEL_MAPPING.get(category, "other") for category in LABEL_ID_TO_CATEGORY
+)
+
+# 可视化颜色映射: FUNSD 标签 -> 颜色
+FUNSD_LABEL_COLORS = {
+    "header": "blue",
+    "answer": "green",
+    "question": "orange",
+    "other": "gray"
+}
+
+# 数据集信息中与本次运行无关的部分
+DATASET_NAME = "Bill of Lading FUNSD Dataset"
+DATASET_DESCRIPTION = "海运单关键字识别数据集（FUNSD格式）"
+DATASET_LABELS = {
+    "funsd_labels": ["header", "question", "answer", "other"],
+    "bol_labels": dict(enumerate(LABEL_ID_TO_NAME))
+}
+
 
 class FUNSDMerger:
     """FUNSD 格式融合器"""
@@ -59,7 +82,9 @@ class FUNSDMerger:
         grouping_dir: Path,
         classification_dir: Path,
         output_dir: Path,
-        vis_dir: Optional[Path] = None
+        vis_dir: Optional[Path] = None,
+        num_workers: Optional[int] = None,
+        jsonl: bool = False
     ):
         self.image_dir = Path(image_dir)
         self.ocr_dir = Path(ocr_dir)
@@ -71,11 +96,17 @@ class FUNSDMerger:
         # 创建目录
         self.output_dir.mkdir(parents=True, exist_ok=True)
         (self.output_dir / "images").mkdir(exist_ok=True)
-        (self.output_dir / "annotations").mkdir(exist_ok=True)
+        if not jsonl:
+            (self.output_dir / "annotations").mkdir(exist_ok=True)
 
         if self.vis_dir:
             self.vis_dir.mkdir(parents=True, exist_ok=True)
 
+        self.num_workers = num_workers or DEFAULT_CONFIG.get("num_workers", 1)
+        # JSONL 模式: 所有标注写入同一个 annotations.jsonl（每行一张图片），由主进程统一写入
+        self.jsonl = jsonl
+        self.jsonl_path = self.output_dir / "annotations.jsonl"
+
         self.stats = {
             "total": 0,
             "success": 0,
@@ -86,64 +117,66 @@ class FUNSDMerger:
     def scan_tasks(self) -> List[Dict[str, Path]]:
         """扫描待处理任务"""
         tasks = []
+        # 每个目录只列举一次，之后用集合判断文件是否存在
+        image_names = image_names_by_stem(self.image_dir)
+        ocr_names = list_file_names(self.ocr_dir)
+        grouping_names = list_file_names(self.grouping_dir)
 
-        for classification_file in self.classification_dir.glob("*.json"):
-            stem = classification_file.stem
+        for classification_name in sorted(list_file_names(self.classification_dir)):
+            if not classification_name.endswith(".json"):
+                continue
+            stem = classification_name[:-len(".json")]
 
             # 查找对应文件
-            image_path = None
-            for ext in ['.png', '.jpg', '.jpeg']:
-                candidate = self.image_dir / f"{stem}{ext}"
-                if candidate.exists():
-                    image_path = candidate
-                    break
+            image_name = image_names.get(stem)
 
-            ocr_path = self.ocr_dir / f"{stem}.json"
-            grouping_path = self.grouping_dir / f"{stem}.json"
-
-            if image_path and ocr_path.exists() and grouping_path.exists():
+            if image_name and classification_name in ocr_names and classification_name in grouping_names:
                 tasks.append({
                     "stem": stem,
-                    "image": image_path,
-                    "ocr": ocr_path,
-                    "grouping": grouping_path,
-                    "classification": classification_file
+                    "image": self.image_dir / image_name,
+                    "ocr": self.ocr_dir / classification_name,
+                    "grouping": self.grouping_dir / classification_name,
+                    "classification": self.classification_dir / classification_name
                 })
 
         self.stats["total"] = len(tasks)
         return tasks
 
-    def merge_boxes(self, boxes: List[Dict]) -> Dict:
-        """合并多个文本框为一个"""
-        if not boxes:
-            return None
+    def merge_groups(self, groups: List[List[int]], text_boxes: Dict[int, Dict]) -> List[Tuple[int, Dict]]:
+        """合并每个分组的文本框，返回 (组索引, 合并结果) 列表，跳过没有有效文本框的组
+
+        所有组的边界框拼成一个 (M, 4) 数组，用 reduceat 一次求出各组的外接框。
+        """
+        group_indices = []
+        group_members = []
+        for group_idx, group in enumerate(groups):
+            group_boxes = [text_boxes[bid] for bid in group if bid in text_boxes]
+            if group_boxes:
+                group_indices.append(group_idx)
+                group_members.append(group_boxes)
 
-        # 合并文本
-        texts = [b["text"] for b in boxes]
-        merged_text = " ".join(texts)
+        if not group_members:
+            return []
 
-        # 合并边界框
-        all_boxes = [b["box"] for b in boxes]
-        x_min = min(b[0] for b in all_boxes)
-        y_min = min(b[1] for b in all_boxes)
-        x_max = max(b[2] for b in all_boxes)
-        y_max = max(b[3] for b in all_boxes)
+        coords = np.array([b["box"] for boxes in group_members for b in boxes], dtype=np.int64)
+        starts = np.cumsum([0] + [len(boxes) for boxes in group_members[:-1]])
+        mins = np.minimum.reduceat(coords[:, :2], starts, axis=0)
+        maxs = np.maximum.reduceat(coords[:, 2:], starts, axis=0)
+        bounds = np.hstack([mins, maxs]).tolist()
 
-        return {
-            "text": merged_text,
-            "box": [x_min, y_min, x_max, y_max]
-        }
+        return [
+            (group_idx, {"text": " ".join(b["text"] for b in boxes), "box": box})
+            for group_idx, boxes, box in zip(group_indices, group_members, bounds)
+        ]
 
     def get_funsd_label(self, label_id: int) -> str:
         """获取 FUNSD 标签"""
-        if label_id in BILL_OF_LADING_LABELS:
-            category = BILL_OF_LADING_LABELS[label_id].get("category", "other")
-            return FUNSD_LABEL_MAPPING.get(category, "other")
+        if 0 <= label_id < len(FUNSD_LABEL_BY_ID):
+            return FUNSD_LABEL_BY_ID[label_id]
         return "other"
 
     def split_text_to_words(self, text: str, box: List[int]) -> List[Dict]:
         """将文本拆分为单词"""
-        words = []
         x1, y1, x2, y2 = box
         width = x2 - x1
 
@@ -152,17 +185,17 @@ class FUNSDMerger:
             return [{"text": "", "box": box}]
 
         char_width = width / max(len(text), 1)
-        current_x = x1
 
-        for part in parts:
-            part_width = len(part) * char_width
-            words.append({
-                "text": part,
-                "box": [int(current_x), y1, int(current_x + part_width), y2]
-            })
-            current_x += part_width + char_width
+        # 按字符数均分宽度，每个单词后跟一个字符宽的空格；
+        # 起点以 x1 开头逐项累加，与逐个累加 current_x 的结果完全一致
+        part_widths = np.fromiter((len(part) for part in parts), dtype=np.float64, count=len(parts)) * char_width
+        starts = np.cumsum(np.concatenate(([x1], part_widths[:-1] + char_width)))
+        ends = starts + part_widths
 
-        return words
+        return [
+            {"text": part, "box": [start, y1, end, y2]}
+            for part, start, end in zip(parts, starts.astype(int).tolist(), ends.astype(int).tolist())
+        ]
 
     def generate_funsd(
         self,
@@ -182,31 +215,28 @@ class FUNSDMerger:
 
         # 获取分组和分类
         groups = grouping_data.get("groups", [])
-        classifications = classification_data.get("classifications", {})
+        # 分类结果的键为组ID字符串，统一转换一次为 int -> int；
+        # 单个条目格式错误（如 null 标签、非数字键）只跳过该条目，对应的组按默认标签处理
+        classifications = {}
+        for group_id, label_id in classification_data.get("classifications", {}).items():
+            try:
+                classifications[int(group_id)] = int(label_id)
+            except (TypeError, ValueError):
+                logger.warning(f"  忽略无效分类: {group_id!r} -> {label_id!r}")
 
         # 构建 FUNSD 实体
         form = []
         entity_id = 0
 
-        for group_idx, group in enumerate(groups):
-            # 获取该组的文本框
-            group_boxes = [text_boxes[bid] for bid in group if bid in text_boxes]
-
-            if not group_boxes:
-                continue
-
-            # 合并文本框
-            merged = self.merge_boxes(group_boxes)
-            if not merged:
-                continue
-
+        for group_idx, merged in self.merge_groups(groups, text_boxes):
             # 获取分类标签
-            label_id = classifications.get(str(group_idx), 27)  # 默认 other
-            if isinstance(label_id, str):
-                label_id = int(label_id)
+            label_id = classifications.get(group_idx, 27)  # 默认 other
 
             funsd_label = self.get_funsd_label(label_id)
-            bol_label = LABEL_ID_TO_NAME.get(label_id, "other")
+            if 0 <= label_id < len(LABEL_ID_TO_NAME):
+                bol_label = LABEL_ID_TO_NAME[label_id]
+            else:
+                bol_label = "other"
 
             # 构建实体
             entity = {
@@ -240,36 +270,27 @@ class FUNSDMerger:
         image = Image.open(image_path).convert("RGB")
         draw = ImageDraw.Draw(image)
 
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 10)
-        except:
-            font = ImageFont.load_default()
-
-        # 颜色映射
-        colors = {
-            "header": "blue",
-            "answer": "green",
-            "question": "orange",
-            "other": "gray"
-        }
+        font = load_font(10)
 
         for entity in funsd_data.get("form", []):
             box = entity["box"]
-            label = entity.get("label", "other")
-            bol_label = entity.get("bol_label", "")
-            color = colors.get(label, "gray")
+            color = FUNSD_LABEL_COLORS.get(entity.get("label", "other"), "gray")
 
             # 画框
             draw.rectangle(box, outline=color, width=2)
 
             # 标注
-            label_text = f"{entity['id']}:{bol_label}"
+            label_text = f"{entity['id']}:{entity.get('bol_label', '')}"
             draw.text((box[0], box[1] - 12), label_text, fill=color, font=font)
 
-        image.save(output_path)
+        image.save(output_path, compress_level=DEFAULT_CONFIG.get("vis_compress_level", 1))
 
-    def process_single(self, task: Dict[str, Path]) -> bool:
-        """处理单个任务"""
+    def merge_single(self, task: Dict[str, Path]) -> Optional[Tuple[int, Optional[bytes]]]:
+        """处理单个任务，返回 (实体数, JSONL 行)，失败返回 None
+
+        JSONL 模式下标注编码为一行 JSON 交给主进程写入，否则直接保存为单独的 JSON 文件。
+        不修改 self.stats，可在子进程中执行。
+        """
         try:
             stem = task["stem"]
             image_path = task["image"]
@@ -297,9 +318,12 @@ class FUNSDMerger:
             shutil.copy2(image_path, output_image_path)
 
             # 保存 JSON
-            output_json_path = self.output_dir / "annotations" / f"{stem}.json"
-            with open(output_json_path, 'w', encoding='utf-8') as f:
-                json.dump(funsd_data, f, ensure_ascii=False, indent=2)
+            line = None
+            if self.jsonl:
+                line = json_line(funsd_data)
+            else:
+                output_json_path = self.output_dir / "annotations" / f"{stem}.json"
+                write_json(output_json_path, funsd_data)
 
             # 可视化
             if self.vis_dir:
@@ -308,38 +332,46 @@ class FUNSDMerger:
 
             entity_count = len(funsd_data.get("form", []))
             logger.info(f"  ✅ 生成 {entity_count} 个实体")
-
-            self.stats["success"] += 1
-            self.stats["total_entities"] += entity_count
-            return True
+            return entity_count, line
 
         except Exception as e:
             logger.error(f"  ❌ 失败: {task['stem']} - {e}")
-            import traceback
             traceback.print_exc()
+            return None
+
+    def _record_result(self, result: Optional[Tuple[int, Optional[bytes]]], jsonl_file=None) -> bool:
+        """汇总单个任务结果到统计信息，JSONL 模式下同时写入标注行"""
+        if result is None:
             self.stats["failed"] += 1
             return False
+        entity_count, line = result
+        if jsonl_file is not None and line is not None:
+            jsonl_file.write(line)
+        self.stats["success"] += 1
+        self.stats["total_entities"] += entity_count
+        return True
+
+    def process_single(self, task: Dict[str, Path], jsonl_file=None) -> bool:
+        """处理单个任务"""
+        return self._record_result(self.merge_single(task), jsonl_file)
 
     def generate_dataset_info(self):
         """生成数据集信息文件"""
         info = {
-            "name": "Bill of Lading FUNSD Dataset",
-            "description": "海运单关键字识别数据集（FUNSD格式）",
+            "name": DATASET_NAME,
+            "description": DATASET_DESCRIPTION,
             "total_images": self.stats["success"],
             "total_entities": self.stats["total_entities"],
-            "labels": {
-                "funsd_labels": ["header", "question", "answer", "other"],
-                "bol_labels": LABEL_ID_TO_NAME
-            },
+            "labels": DATASET_LABELS,
             "structure": {
                 "images/": "图片文件",
-                "annotations/": "JSON标注文件"
+                **({"annotations.jsonl": "JSONL标注文件（每行一张图片）"} if self.jsonl
+                   else {"annotations/": "JSON标注文件"})
             }
         }
 
         info_path = self.output_dir / "dataset_info.json"
-        with open(info_path, 'w', encoding='utf-8') as f:
-            json.dump(info, f, ensure_ascii=False, indent=2)
+        write_json(info_path, info)
 
         logger.info(f"数据集信息已保存: {info_path}")
 
@@ -361,9 +393,26 @@ class FUNSDMerger:
 
         logger.info(f"找到 {len(tasks)} 个待处理任务\n")
 
-        for i, task in enumerate(tasks, 1):
-            logger.info(f"[{i}/{len(tasks)}]")
-            self.process_single(task)
+        # JSONL 模式每次运行重新生成整个文件，只由主进程写入，无需加锁
+        jsonl_file = open(self.jsonl_path, 'wb') if self.jsonl else None
+        try:
+            workers = min(self.num_workers, len(tasks))
+            if workers > 1:
+                # 各任务互相独立，按进程并行处理
+                logger.info(f"并行进程数: {workers}")
+                chunksize = max(1, len(tasks) // (workers * 4))
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    results = executor.map(self.merge_single, tasks, chunksize=chunksize)
+                    for i, result in enumerate(results, 1):
+                        logger.info(f"[{i}/{len(tasks)}]")
+                        self._record_result(result, jsonl_file)
+            else:
+                for i, task in enumerate(tasks, 1):
+                    logger.info(f"[{i}/{len(tasks)}]")
+                    self.process_single(task, jsonl_file)
+        finally:
+            if jsonl_file is not None:
+                jsonl_file.close()
 
         # 生成数据集信息
         self.generate_dataset_info()
@@ -389,6 +438,8 @@ def main():
     parser.add_argument('--classification-dir', type=str, help='分类结果目录')
     parser.add_argument('-o', '--output', type=str, help='输出目录')
     parser.add_argument('-v', '--visualize', action='store_true', help='生成可视化')
+    parser.add_argument('-j', '--workers', type=int, help='并行进程数（默认: 配置中的 num_workers）')
+    parser.add_argument('--jsonl', action='store_true', help='标注写入单个 annotations.jsonl，而不是每张图片一个 JSON 文件')
     args = parser.parse_args()
 
     ensure_directories()
@@ -402,7 +453,7 @@ def main():
 
     merger = FUNSDMerger(
         image_dir, ocr_dir, grouping_dir, classification_dir,
-        output_dir, vis_dir
+        output_dir, vis_dir, num_workers=args.workers, jsonl=args.jsonl
     )
     merger.run()
 
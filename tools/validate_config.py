@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+配置静态校验 (pre-commit)
+Static Config Validation
+
+校验 config.py / labels.py 中与运行环境无关的部分，在提交时执行，
+运行时的 run_pipeline.check_config 只保留 API 密钥、输入文件等环境检查。
+
+用法:
+  python tools/validate_config.py
+"""
+
+import sys
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from config import DEFAULT_CONFIG, PATHS, PROJECT_ROOT as CONFIG_ROOT  # noqa: E402
+from labels import BILL_OF_LADING_LABELS  # noqa: E402
+
+# 必需的配置项及其类型
+REQUIRED_CONFIG = {
+    "base_url": str,
+    "model_name": str,
+    "batch_size": int,
+    "interval": (int, float),
+    "vlm_json_mode": bool,
+    "vlm_max_retries": int,
+    "vlm_timeout": (int, float),
+    "vlm_cache": bool,
+    "image_dpi": int,
+    "only_first_page": bool,
+    "vis_compress_level": int,
+    "ocr_lang": str,
+    "ocr_workers": int,
+    "ocr_cache": bool,
+    "ocr_enable_mkldnn": bool,
+    "ocr_cpu_threads": int,
+    "ocr_precision": str,
+    "confidence_threshold": (int, float),
+    "num_workers": int,
+}
+
+REQUIRED_LABEL_FIELDS = ("name", "name_cn", "category")
+
+
+def validate_default_config() -> list:
+    """校验 DEFAULT_CONFIG 的键和类型"""
+    errors = []
+    for key, expected in REQUIRED_CONFIG.items():
+        if key not in DEFAULT_CONFIG:
+            errors.append(f"DEFAULT_CONFIG 缺少配置项: {key}")
+        elif not isinstance(DEFAULT_CONFIG[key], expected):
+            errors.append(f"DEFAULT_CONFIG[{key!r}] 类型错误: {type(DEFAULT_CONFIG[key]).__name__}")
+
+    if DEFAULT_CONFIG.get("batch_size", 1) < 1:
+        errors.append("batch_size 必须 >= 1")
+    if DEFAULT_CONFIG.get("vlm_max_retries", 0) < 0:
+        errors.append("vlm_max_retries 必须 >= 0")
+    if DEFAULT_CONFIG.get("vlm_timeout", 1) <= 0:
+        errors.append("vlm_timeout 必须 > 0")
+    if DEFAULT_CONFIG.get("num_workers", 1) < 1:
+        errors.append("num_workers 必须 >= 1")
+    if not 0 <= DEFAULT_CONFIG.get("confidence_threshold", 0) <= 1:
+        errors.append("confidence_threshold 必须在 0-1 之间")
+    if DEFAULT_CONFIG.get("ocr_precision", "fp32") not in ("fp32", "fp16", "int8"):
+        errors.append("ocr_precision 必须是 fp32、fp16 或 int8")
+    return errors
+
+
+def validate_paths() -> list:
+    """校验 PATHS 均位于项目目录下"""
+    errors = []
+    for name, path in PATHS.items():
+        try:
+            path.relative_to(CONFIG_ROOT)
+        except ValueError:
+            errors.append(f"PATHS[{name!r}] 不在项目目录下: {path}")
+    return errors
+
+
+def validate_labels() -> list:
+    """校验标签表: ID 连续、字段完整、名称唯一"""
+    errors = []
+    if sorted(BILL_OF_LADING_LABELS) != list(range(len(BILL_OF_LADING_LABELS))):
+        errors.append("标签ID必须是从 0 开始的连续整数")
+
+    seen = set()
+    for label_id, info in BILL_OF_LADING_LABELS.items():
+        for field in REQUIRED_LABEL_FIELDS:
+            if not info.get(field):
+                errors.append(f"标签 {label_id} 缺少字段: {field}")
+        name = info.get("name")
+        if name in seen:
+            errors.append(f"标签名称重复: {name}")
+        seen.add(name)
+    return errors
+
+
+def main():
+    errors = validate_default_config() + validate_paths() + validate_labels()
+    if errors:
+        sys.stdout.write("".join(f"❌ {err}\n" for err in errors))
+        sys.exit(1)
+    sys.stdout.write("✅ 配置校验通过\n")
+
+
+if __name__ == "__main__":
+    main()